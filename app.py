@@ -1,8 +1,10 @@
 import streamlit as st
 from groq import Groq
 from io import BytesIO
-import json, re
-from docx import Document
+import copy, json, re, threading
+from collections import OrderedDict
+from itertools import islice
+from doc_utils import load_docx, extract_placeholders_with_context, replace_placeholders, get_missing, build_key_index, match_placeholders, iter_para_texts, iter_docx_texts
 from dotenv import load_dotenv
 import os
 load_dotenv()
@@ -35,81 +37,101 @@ else:
 
 # Groq client available as `client`
 
-def load_docx(data): return Document(data)
-# helper: load a .docx into python-docx Document
-
-def extract_placeholders_with_context(doc, window=1):
-    regex = re.compile(r"(\$?\[+[^\[\]]+\]+)")
-    placeholders, contexts = [], {}
-    for i,p in enumerate(doc.paragraphs):
-        found = regex.findall(p.text)
-        if found:
-            context=[]
-            for off in range(-window,window+1):
-                j=i+off
-                if 0<=j<len(doc.paragraphs):
-                    t=doc.paragraphs[j].text.strip()
-                    if t: context.append(t)
-            for f in found:
-                placeholders.append(f)
-                contexts[f]=" ".join(context)
-    uniq, seen = [], set()
-    for ph in placeholders:
-        if ph not in seen:
-            uniq.append(ph)
-            seen.add(ph)
-    return uniq, contexts
-# helper: extract placeholders and nearby paragraph context
-
-def replace_placeholders(doc,mapping):
-    def repl(txt):
-        for k,v in mapping.items(): txt=txt.replace(k,v)
-        return txt
-    for p in doc.paragraphs:
-        if any(k in p.text for k in mapping):
-            new=repl(p.text)
-            for i in range(len(p.runs)-1,-1,-1):
-                p.runs[i]._element.getparent().remove(p.runs[i]._element)
-            p.add_run(new)
-    for t in doc.tables:
-        for r in t.rows:
-            for c in r.cells:
-                if any(k in c.text for k in mapping):
-                    c._tc.clear_content()
-                    c.add_paragraph(repl(c.text))
-    return doc
-# helper: replace placeholders in paragraphs and table cells
-
-def get_missing(values): return [k for k,v in values.items() if not v.strip()]
-# helper: list placeholders with empty values
-
-def analyze_placeholder_contexts(placeholders,contexts,client):
+CHAT_MODEL = "llama-3.3-70b-versatile"
+FAST_MODEL = "llama-3.1-8b-instant"
+# 70B for the conversation, 8B for the simple description/example analysis
+
+high_quality_analysis = st.sidebar.toggle("High-quality analysis (slower)", value=False)
+analysis_model = CHAT_MODEL if high_quality_analysis else FAST_MODEL
+# sidebar toggle: route placeholder analysis to the 70B model when quality matters more than speed
+
+JSON_BLOCK_RE = re.compile(r"\{.*\}", re.S)
+# precompiled pattern for the JSON block in LLM replies
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def template_docx(file_bytes): return load_docx(BytesIO(file_bytes))
+# helper: parsed template Document for generation, shared and never mutated (deep-copy before filling)
+
+@st.cache_data(show_spinner=False)
+def parse_docx(file_bytes):
+    try: texts = iter_docx_texts(file_bytes)
+    except KeyError: texts = iter_para_texts(template_docx(file_bytes))  # unusual package layout: let python-docx resolve it
+    placeholders, contexts = extract_placeholders_with_context(texts)
+    context_text = "\n".join(f"{ph}: {contexts.get(ph,'')}" for ph in placeholders)
+    return placeholders, contexts, context_text
+# helper: parse uploaded bytes once per upload (cached across reruns); context_text feeds the chat prompt
+
+ANALYSIS_BATCH_SIZE = 10
+# placeholders analyzed per LLM request
+
+ANALYSIS_CACHE_SIZE = 2000
+# most placeholder analyses kept in memory across all sessions
+
+@st.cache_resource(ttl=24*60*60, show_spinner=False)
+def analysis_cache(): return OrderedDict(), threading.Lock()
+# shared across sessions: (placeholder, context, model) -> {"description","example"}, LRU-capped, reset daily
+
+def cached_analysis(key):
+    cache,lock=analysis_cache()
+    with lock:
+        info=cache.get(key)
+        if info is not None: cache.move_to_end(key)
+        return info
+# helper: look up a shared analysis, marking it recently used
+
+def store_analysis(key,info):
+    cache,lock=analysis_cache()
+    with lock:
+        cache[key]=info
+        cache.move_to_end(key)
+        while len(cache)>ANALYSIS_CACHE_SIZE: cache.popitem(last=False)
+# helper: add a shared analysis, evicting the least recently used past ANALYSIS_CACHE_SIZE
+
+def analyze_placeholder_contexts(placeholders,contexts,client,model=FAST_MODEL,batch_size=ANALYSIS_BATCH_SIZE):
     results={}
     for ph in placeholders:
-        ctx=contexts.get(ph,"")
+        info=cached_analysis((ph,contexts.get(ph,""),model))
+        if info is not None: results[ph]=info
+    todo=[ph for ph in placeholders if ph not in results]
+    for b in range(0,len(todo),batch_size):
+        batch=todo[b:b+batch_size]
+        items="\n".join(
+            f"[{i}] Placeholder: {ph}\n    Context: {contexts.get(ph,'')}"
+            for i,ph in enumerate(batch,1)
+        )
         prompt=f"""
 You are a legal-document analyst.
-Describe what information this placeholder expects and give one realistic example.
-Respond only in JSON:
-{{"description":"...","example":"..."}}
+For each numbered placeholder below, describe what information it expects and give one realistic example.
+Respond only in JSON, as an object keyed by the index 1..{len(batch)}:
+{{"1":{{"description":"...","example":"..."}}, "2":{{"description":"...","example":"..."}}}}
 
-Placeholder: {ph}
-Context: {ctx}
+{items}
 """
         try:
             r=client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
+                model=model,
                 messages=[{"role":"user","content":prompt}],
                 temperature=0.2,
-                max_tokens=200,
+                max_tokens=200*len(batch),
             )
             text=r.choices[0].message.content
-            m=re.search(r"\{.*\}",text,re.S)
-            results[ph]=json.loads(m.group(0)) if m else {"description":text.strip(),"example":""}
+            m=JSON_BLOCK_RE.search(text)
+            parsed=json.loads(m.group(0)) if m else {}
+            for i,ph in enumerate(batch,1):
+                info=parsed.get(str(i))
+                if isinstance(info,dict):
+                    results[ph]=info
+                    store_analysis((ph,contexts.get(ph,""),model),info)
+                else:
+                    results[ph]={"description":"No analysis returned.","example":"","failed":True}
         except Exception as e:
-            results[ph]={"description":f"Analysis failed: {e}","example":""}
+            for ph in batch:
+                results[ph]={"description":f"Analysis failed: {e}","example":"","failed":True}
     return results
-# helper: call LLM to analyze placeholder meanings (returns JSON or error)
+# helper: call LLM to analyze placeholder meanings not already cached (returns JSON, or an error entry flagged "failed")
+
+def analyze_placeholder(ph,ctx,client,model=FAST_MODEL): return analyze_placeholder_contexts([ph],{ph:ctx},client,model)[ph]
+# helper: analyze a single placeholder on demand
 
 uploaded = st.file_uploader("Upload your .docx document", type=["docx"], key="main_docx_uploader")
 # file uploader: user must upload a .docx to proceed
@@ -117,27 +139,43 @@ if not uploaded:
     st.info("Please upload a .docx file to continue.")
     st.stop()
 
-doc = load_docx(uploaded)
-placeholders, contexts = extract_placeholders_with_context(doc)
+if st.session_state.get("upload_id") != uploaded.file_id:
+    st.session_state.upload_id = uploaded.file_id
+    st.session_state.doc_bytes = uploaded.getvalue()
+    for k in ("analysis","chat_history","placeholder_values","meanings_text","meanings_for","filled_doc","last_generated"):
+        st.session_state.pop(k, None)
+doc_bytes = st.session_state.doc_bytes
+# read the upload once; the same bytes object then keys every cache, and a new file starts a fresh session
+placeholders, contexts, context_text = parse_docx(doc_bytes)
 if not placeholders:
     st.warning("No placeholders found – ensure they use [brackets].")
     st.stop()
 
 st.subheader(f"Detected {len(placeholders)} placeholders")
+key_index = build_key_index(placeholders)
+# lookup used to map LLM-returned keys back to placeholders
 
 # ---------------- AI Analysis ----------------
-st.write("Analyzing placeholder contexts with Groq Llama 3.3 70B …")
-analysis = analyze_placeholder_contexts(placeholders, contexts, client)
-# use LLM to analyze each placeholder (async call to Groq)
+if "analysis" not in st.session_state:
+    st.session_state.analysis={}
+analysis = st.session_state.analysis
+# placeholder insights are fetched lazily (per expander, or in one batch on the first chat turn)
 
 st.subheader("AI-Generated Insights (Lexi’s Understanding)")
 for ph in placeholders:
-    info = analysis.get(ph, {})
     with st.expander(ph):
         st.markdown(f"**Context:** {contexts.get(ph,'')}")
-        st.markdown(f"**Lexi’s Insight:** {info.get('description','')}")
-        if info.get("example"):
-            st.markdown(f"**Example:** {info['example']}")
+        if ph not in analysis and st.button("Ask Lexi what this means", key=f"analyze_{ph}"):
+            with st.spinner("Analyzing with Groq …"):
+                info = analyze_placeholder(ph, contexts.get(ph,""), client, analysis_model)
+            # failures are shown but not kept, so the button stays and the next try can succeed
+            if info.get("failed"): st.warning(info["description"])
+            else: analysis[ph] = info
+        if ph in analysis:
+            info = analysis[ph]
+            st.markdown(f"**Lexi’s Insight:** {info.get('description','')}")
+            if info.get("example"):
+                st.markdown(f"**Example:** {info['example']}")
 
 if "chat_history" not in st.session_state:
     st.session_state.chat_history=[]
@@ -159,10 +197,8 @@ def lexi_intro():
 if not st.session_state.chat_history:
     st.session_state.chat_history.append({"role":"assistant","content":lexi_intro()})
 
-def groq_conversation(user_msg,history,placeholders,values,contexts,analysis):
+def groq_conversation(user_msg,history,values,meanings,context_text,key_index):
     missing=get_missing(values)
-    meanings="\n".join(f"{ph}: {analysis.get(ph,{}).get('description','')}" for ph in placeholders)
-    context_text="\n".join(f"{ph}: {contexts.get(ph,'')}" for ph in placeholders)
 
     sys_prompt = (
         "You are Lexi, a friendly but professional AI legal assistant helping the user fill placeholders in a legal document. "
@@ -172,65 +208,85 @@ def groq_conversation(user_msg,history,placeholders,values,contexts,analysis):
         "If any placeholders remain empty, gently remind the user which ones are still missing."
     )
 
-    msgs=[{"role":"system","content":sys_prompt}]+history
+    # invariant prefix first (instructions, meanings, contexts), then history, then only the per-turn state,
+    # so consecutive requests share the longest possible prompt prefix
+    msgs=[
+        {"role":"system","content":sys_prompt},
+        {"role":"system","content":f"Placeholder meanings:\n{meanings}\n\nContexts:\n{context_text}"},
+    ]+history
     msgs.append({
         "role":"user",
         "content":(
             f"Current mapping: {json.dumps(values)}\n"
-            f"Missing: {missing}\n"
-            f"Placeholder meanings:\n{meanings}\n"
-            f"Contexts:\n{context_text}\n\n"
+            f"Missing: {missing}\n\n"
             f"User message: {user_msg}"
         ),
     })
 
     resp=client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
+        model=CHAT_MODEL,
         messages=msgs,
         temperature=0.4,
         max_tokens=800,
+        stream=True,
     )
-    content=resp.choices[0].message.content
+    # show tokens as they arrive; the JSON mapping is parsed from the accumulated text
+    content=st.write_stream(chunk.choices[0].delta.content or "" for chunk in resp)
     reply=content
-    m=re.search(r"\{.*\}",content,re.S)
+    m=JSON_BLOCK_RE.search(content)
     if m:
         try:
             parsed=json.loads(m.group(0))
             for k,v in parsed.items():
-                for ph in placeholders:
-                    if k.strip().lower().replace(" ","") in ph.lower().replace(" ",""):
-                        values[ph]=v
+                for ph in match_placeholders(k,key_index):
+                    values[ph]=v
         except Exception:
             pass
     miss_after=get_missing(values)
     if miss_after:
-        reply += f"\n\n(Remaining fields: {', '.join(miss_after)})"
+        status=f"(Remaining fields: {', '.join(miss_after)})"
     else:
-        reply += "\n\n✅ Great! All placeholders are filled — I can generate the final document when you're ready."
+        status="✅ Great! All placeholders are filled — I can generate the final document when you're ready."
+    st.write(status)
+    reply += f"\n\n{status}"
     return reply, values
-# groq_conversation: build prompt, call LLM, parse JSON mapping and update values
+# groq_conversation: build prompt, stream the LLM reply, parse JSON mapping and update values
 
 st.header("Chat with Lexi")
 
 user_msg = st.chat_input("Type your response here …")
 
+for msg in st.session_state.chat_history:
+    with st.chat_message(msg["role"]):
+        st.write(msg["content"])
+
 if user_msg:
     st.session_state.chat_history.append({"role":"user","content":user_msg})
-    reply,updated=groq_conversation(
-        user_msg,
-        st.session_state.chat_history,
-        placeholders,
-        st.session_state.placeholder_values,
-        contexts,
-        analysis,
-    )
+    with st.chat_message("user"):
+        st.write(user_msg)
+    pending=[ph for ph in placeholders if ph not in analysis]
+    if pending:
+        with st.spinner("Lexi is reviewing the placeholders …"):
+            results = analyze_placeholder_contexts(pending, contexts, client, analysis_model)
+        analysis.update({ph:info for ph,info in results.items() if not info.get("failed")})
+    # failed placeholders stay pending and are retried on the next chat turn
+    analyzed=frozenset(analysis)
+    if st.session_state.get("meanings_for") != analyzed:
+        st.session_state.meanings_text="\n".join(f"{ph}: {analysis.get(ph,{}).get('description','')}" for ph in placeholders)
+        st.session_state.meanings_for=analyzed
+    # meanings only change when analysis gains entries (chat batch or expander button), so the joined text is kept otherwise
+    with st.chat_message("assistant"):
+        reply,updated=groq_conversation(
+            user_msg,
+            st.session_state.chat_history[:-1],
+            st.session_state.placeholder_values,
+            st.session_state.meanings_text,
+            context_text,
+            key_index,
+        )
     st.session_state.placeholder_values=updated
     st.session_state.chat_history.append({"role":"assistant","content":reply})
 
-for msg in st.session_state.chat_history:
-    with st.chat_message(msg["role"]):
-        st.write(msg["content"])
-
 filled = sum(1 for v in st.session_state.placeholder_values.values() if v)
 st.progress(filled/len(placeholders))
 st.write(f"Filled {filled}/{len(placeholders)} placeholders.")
@@ -269,7 +325,7 @@ def show_final_dialog(filled_doc):
         mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
     )
 
-    preview = [p.text for p in filled_doc.paragraphs[:30] if p.text.strip()]
+    preview = list(islice((t for t in iter_para_texts(filled_doc) if t.strip()), 30))
     st.subheader("Preview (first few paragraphs)")
     st.text("\n\n".join(preview))
     st.info("Close this dialog to continue chatting with Lexi.")
@@ -277,7 +333,11 @@ def show_final_dialog(filled_doc):
 if not missing_now:
     st.success("✅ All placeholders are filled — Lexi can now generate the final document.")
     if st.button("Generate Final Document"):
-        filled_doc = replace_placeholders(load_docx(uploaded), st.session_state.placeholder_values)
-        show_final_dialog(filled_doc)
+        values = st.session_state.placeholder_values
+        # regenerate only if the document or any value changed since the last click
+        if st.session_state.get("last_generated") != (doc_bytes, values):
+            st.session_state.filled_doc = replace_placeholders(copy.deepcopy(template_docx(doc_bytes)), values)
+            st.session_state.last_generated = (doc_bytes, dict(values))
+        show_final_dialog(st.session_state.filled_doc)
 else:
     st.info(f"Lexi: We’re almost done — still need {', '.join(missing_now)} before generating the document.")
\ No newline at end of file
@@ -0,0 +1,112 @@
+import re, zipfile
+from io import BytesIO
+from docx import Document
+from docx.oxml.ns import qn
+from docx.oxml.parser import parse_xml
+from docx.text.paragraph import Paragraph
+from lxml import etree
+# document helpers shared by the Streamlit app (no Streamlit dependency here)
+
+PLACEHOLDER_PATTERN = r"(\$?\[++[^\[\]]++\]++)"
+# placeholders like [Name] / $[Amount]; possessive quantifiers match the same text as
+# r"(\$?\[+[^\[\]]+\]+)" but never backtrack through long runs of unclosed brackets
+try:
+    import regex
+    PLACEHOLDER_RE = regex.compile(PLACEHOLDER_PATTERN)
+except ImportError:
+    try: PLACEHOLDER_RE = re.compile(PLACEHOLDER_PATTERN)  # stdlib re supports possessive quantifiers from 3.11
+    except re.error: PLACEHOLDER_RE = re.compile(r"(\$?\[+[^\[\]]+\]+)")
+# precompiled placeholder pattern: third-party `regex` if installed, else stdlib re
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+W = "{%s}" % W_NS
+# WordprocessingML namespace, and its Clark-notation prefix for tag comparisons
+
+def load_docx(data): return Document(data)
+# helper: load a .docx into python-docx Document
+
+PARA_TEXT_XPATH = etree.XPath(
+    "(w:r | w:hyperlink/w:r)/*[self::w:t or self::w:tab or self::w:ptab or self::w:br or self::w:cr or self::w:noBreakHyphen]",
+    namespaces={"w": W_NS},
+)
+PARA_RUNS_XPATH = etree.XPath("w:r | w:hyperlink", namespaces={"w": W_NS})
+# compiled once: element.xpath() would re-parse the expression for every paragraph
+
+def run_item_text(el):
+    tag = el.tag
+    if tag == W+"t": return el.text or ""
+    if tag in (W+"tab", W+"ptab"): return "\t"
+    if tag == W+"cr": return "\n"
+    if tag == W+"br": return "\n" if el.get(W+"type","textWrapping") == "textWrapping" else ""
+    if tag == W+"noBreakHyphen": return "-"
+    return ""
+# helper: text equivalent of a run child, matching python-docx's Run.text (page/column breaks are "")
+
+def para_text(p_el): return "".join(map(run_item_text, PARA_TEXT_XPATH(p_el)))
+# helper: text of a <w:p> element's own runs (not nested text boxes)
+
+def iter_para_texts(doc):
+    for p_el in doc.element.body.iter(qn("w:p")): yield para_text(p_el)
+# helper: stream paragraph texts (body and table cells) straight from the XML
+
+def main_part_name(z):
+    for rel in parse_xml(z.read("_rels/.rels")):
+        if rel.get("Type","").endswith("/officeDocument"): return rel.get("Target").lstrip("/")
+    raise KeyError("no officeDocument relationship in _rels/.rels")
+# helper: zip member holding the main document (word/document.xml, or e.g. word/document2.xml from Word Online)
+
+def iter_docx_texts(file_bytes):
+    with zipfile.ZipFile(BytesIO(file_bytes)) as z:
+        root = parse_xml(z.read(main_part_name(z)))
+    return (para_text(p_el) for p_el in root.iter(qn("w:p")))
+# helper: paragraph texts straight from the main document part, without building a python-docx Document;
+# parsed with python-docx's entity-safe parser and the same para_text as generation
+
+def extract_placeholders_with_context(texts, window=1):
+    texts = list(texts)
+    placeholders, contexts = [], {}
+    for i,text in enumerate(texts):
+        if "[" not in text: continue  # most clauses have no placeholder; skip the regex engine
+        found = PLACEHOLDER_RE.findall(text)
+        if found:
+            context=[t.strip() for t in texts[max(0,i-window):i+window+1] if t.strip()]
+            for f in found:
+                placeholders.append(f)
+                contexts[f]=" ".join(context)
+    return list(dict.fromkeys(placeholders)), contexts
+# helper: extract placeholders and nearby paragraph context from a sequence of paragraph texts
+
+def replace_placeholders(doc,mapping):
+    if not mapping: return doc
+    # one alternation, longest keys first so "$[Amount]" wins over "[Amount]"
+    pattern=re.compile("|".join(map(re.escape,sorted(mapping,key=len,reverse=True))))
+    def repl(txt): return pattern.subn(lambda m: mapping[m.group(0)],txt)
+    # snapshot the paragraph list first: rewriting runs while iterating the tree is unsafe
+    for p_el in list(doc.element.body.iter(qn("w:p"))):
+        # para_text maps w:tab/w:br/w:cr to "\t"/"\n", and add_run turns them back into elements
+        new,n=repl(para_text(p_el))
+        if n:
+            for r in PARA_RUNS_XPATH(p_el): p_el.remove(r)
+            Paragraph(p_el,None).add_run(new)
+    return doc
+# helper: replace placeholders in paragraphs and table cells
+
+def norm_key(s): return s.strip().lower().replace(" ","").strip("[]$")
+# helper: normalize a placeholder or LLM key for matching ("$[Company Name]" -> "companyname")
+
+def build_key_index(placeholders):
+    norm={}
+    for ph in placeholders: norm.setdefault(norm_key(ph),[]).append(ph)
+    return set(placeholders), norm
+# helper: (exact placeholders, normalized key -> placeholders), built once per upload
+
+def match_placeholders(key,index):
+    exact,norm=index
+    if key.strip() in exact: return [key.strip()]  # "$[Amount]" must not also fill "[Amount]"
+    nk=norm_key(key)
+    if nk in norm: return norm[nk]
+    return [ph for n,phs in norm.items() if nk and nk in n for ph in phs]
+# helper: exact placeholder, then normalized lookup, then substring fallback ("Company" -> [Company Name])
+
+def get_missing(values): return [k for k,v in values.items() if not v.strip()]
+# helper: list placeholders with empty values